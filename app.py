@@ -1,102 +1,76 @@
-import time
-import ultralytics
-import os
+import collections
+import functools
+import hashlib
+import io
 import json
-import boto3
-import requests
-import uuid
-import yaml
-import sys
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from loguru import logger
-from pymongo import MongoClient, errors
-from pymongo.write_concern import WriteConcern
-import urllib3
-import pymongo
-
-pymongo.common.VALIDATORS["replicaSet"] = lambda x: True  # Avoid strict validation issues
-
-# --- AWS Secrets Manager Setup ---
-logger.remove()  # Remove default handler
-logger.add(sys.stderr, level="INFO")
 
-region_name = "eu-north-1"
+import cv2
+import numpy as np
+import orjson
+import requests
+import torch
+import ultralytics
+import urllib3
+from bson import ObjectId
+from loguru import logger
+from prometheus_client import Histogram, start_http_server
+from pymongo import errors
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# --- Load Secrets from AWS Secrets Manager ---
-def load_secrets():
-    """Retrieve all secrets from AWS Secrets Manager"""
-    try:
-        secrets_client = boto3.client("secretsmanager", region_name=region_name)
-        response = secrets_client.get_secret_value(SecretId="polybot-secrets")
-        secrets = json.loads(response["SecretString"])
-        logger.info("Loaded secrets from AWS Secrets Manager")
-        return secrets
-    except Exception as e:
-        logger.error(f"Failed to load secrets from AWS Secrets Manager: {e}")
-        raise
+try:
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TurboJPEG
+except ImportError:
+    TurboJPEG = None
 
-# Load secrets once
-secrets = load_secrets()
-
-# --- Environment Variables ---
-os.environ["S3_BUCKET_NAME"] = secrets.get("S3_BUCKET_NAME", "")
-os.environ["SQS_QUEUE_URL"] = secrets.get("SQS_QUEUE_URL", "")
-os.environ["TELEGRAM_APP_URL"] = secrets.get("TELEGRAM_APP_URL", "")
-os.environ["POLYBOT_URL"] = secrets.get("POLYBOT_URL", "")
-
-images_bucket = os.getenv("S3_BUCKET_NAME")
-queue_url = os.getenv("SQS_QUEUE_URL")
-polybot_url = os.getenv("POLYBOT_URL")
-
-# --- AWS Clients ---
-sqs_client = boto3.client(
-    "sqs",
-    aws_access_key_id=secrets.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=secrets.get("AWS_SECRET_ACCESS_KEY"),
-    region_name=region_name,
-)
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=secrets.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=secrets.get("AWS_SECRET_ACCESS_KEY"),
-    region_name=region_name,
+from config import (
+    collection,
+    images_bucket,
+    polybot_url,
+    queue_url,
+    s3_client,
+    source_etag_indexed,
+    sqs_client,
+    transfer_config,
 )
 
-# --- MongoDB Connection with Retry ---
-def connect_to_mongo():
-    mongo_uri = secrets.get("MONGO_URI")
-    mongo_client = MongoClient(mongo_uri, retryWrites=True, retryReads=True, serverSelectionTimeoutMS=30000)
-    logger.info(f"Initial servers: {mongo_client.nodes}")
-    if not mongo_uri:
-        logger.error("MONGO_URI is missing from secrets")
-        raise ValueError("MONGO_URI is missing from AWS Secrets Manager")
-    logger.info(f"Using MONGO_URI before connection: {mongo_uri}")
-    max_retries = 5
-    for attempt in range(1, max_retries + 1):
-        try:
-            logger.info(f"Attempt {attempt} with MONGO_URI: {mongo_uri}")
-            mongo_client = MongoClient(mongo_uri, retryWrites=True, retryReads=True)
-            db = mongo_client[secrets.get("MONGO_DB", "config")]
-            collection = db[secrets.get("MONGO_COLLECTION", "image_collection")]
-            mongo_client.admin.command("ping")
-            logger.info("Connected to MongoDB successfully")
-            return collection
-        except (errors.ConnectionFailure, errors.NotPrimaryError) as e:
-            logger.error(f"MongoDB connection attempt {attempt} failed: {e}")
-            if attempt < max_retries:
-                time.sleep(2 ** attempt)
-    logger.error("MongoDB connection failed after retries")
-    raise ConnectionError("Could not connect to MongoDB after multiple retries")
-
-# Initialize MongoDB connection
-collection = connect_to_mongo()
+# --- Polybot HTTP Session ---
+# Keep-alive connection pool so notifications reuse TCP/TLS connections
+polybot_session = requests.Session()
+# Only retry the POST where Polybot can't have handled it: connection errors and 503 (not accepting
+# requests). No read retries and no 502/504, since a slow or proxied request may already have been served
+polybot_retry = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.2,
+    status_forcelist=[503],
+    allowed_methods=frozenset({"POST"}),
+    raise_on_status=False,
+)
+polybot_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=polybot_retry)
+polybot_session.mount("http://", polybot_adapter)
+polybot_session.mount("https://", polybot_adapter)
+# Bodies are pre-serialized with orjson, so the JSON content type is set once here
+polybot_session.headers["Content-Type"] = "application/json"
+# Polybot is reached with certificate verification off; silence the warning once instead of per request
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # --- Load Class Names ---
+@functools.lru_cache(maxsize=1)
 def load_class_names():
-    """Load COCO class names from YAML file."""
+    """Load COCO class names from the JSON list pre-generated from coco128.yaml at build time."""
     try:
-        with open("data/coco128.yaml", "r") as stream:
-            names = yaml.safe_load(stream)["names"]
+        with open("data/coco128_names.json", "r") as stream:
+            names = tuple(json.load(stream))
         logger.info("Loaded class names successfully")
         return names
     except Exception as e:
@@ -104,172 +78,604 @@ def load_class_names():
         raise
 
 names = load_class_names()
+# Object array so a whole image's class ids map to names in one fancy-indexing gather
+names_array = np.array(names, dtype=object)
 
 # --- Load YOLO Model with Download Check ---
 model_path = "yolov5su.pt"
 model_url = "https://github.com/ultralytics/assets/releases/download/v8.3.0/yolov5su.pt"
 
+# Optional expected SHA-256 of the model file; a mismatching download is discarded
+model_sha256 = os.getenv("MODEL_SHA256", "").lower()
+
 def download_model(url, filepath):
     """Download the YOLO model if it doesn't exist."""
     if not os.path.exists(filepath):
         logger.info(f"Downloading model from {url} to {filepath}")
-        response = requests.get(url, stream=True)
-        total_size = int(response.headers.get("content-length", 0))
-        with open(filepath, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    downloaded = min(total_size, f.tell())
-                    logger.debug(f"Downloaded {downloaded / 1024 / 1024:.2f} MB / {total_size / 1024 / 1024:.2f} MB")
-        logger.info(f"Model downloaded successfully to {filepath}")
+        # Stream into a .part file and rename at the end so a crashed download never looks complete
+        part_path = f"{filepath}.part"
+        digest = hashlib.sha256()
+        with requests.get(url, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status()
+            total_size = int(response.headers.get("content-length", 0))
+            with open(part_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+                        downloaded = min(total_size, f.tell())
+                        logger.debug(f"Downloaded {downloaded / 1024 / 1024:.2f} MB / {total_size / 1024 / 1024:.2f} MB")
+        sha256 = digest.hexdigest()
+        if model_sha256 and sha256 != model_sha256:
+            os.remove(part_path)
+            raise ValueError(f"Model checksum mismatch: expected {model_sha256}, got {sha256}")
+        os.replace(part_path, filepath)
+        logger.info(f"Model downloaded successfully to {filepath} (sha256 {sha256})")
     else:
         logger.info(f"Model already exists at {filepath}, skipping download.")
 
-# Download model if not present
-download_model(model_url, model_path)
+# --- Load YOLO Model Once ---
+SQS_MAX_MESSAGES = 10  # SQS maximum for a single receive_message call
+# Max images per forward pass; filled from several receives, and the TensorRT engine's max batch
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "16"))
+# How long a partial batch waits for more images before it is run anyway
+BATCH_TIMEOUT = int(os.getenv("BATCH_TIMEOUT_MS", "50")) / 1000
+device = "cuda" if torch.cuda.is_available() else "cpu"
+half = device == "cuda"  # FP16 inference halves activation memory and uses Tensor Cores on GPU
+# Inference backend: "tensorrt" (NVIDIA GPU), "onnx" (ONNX Runtime, CUDA or CPU provider),
+# "openvino" (Intel CPU/iGPU) or "pytorch" (fused eager model)
+MODEL_BACKENDS = ("tensorrt", "onnx", "openvino", "pytorch")
+# Default to an exported backend on both: TensorRT on GPU, OpenVINO on CPU-only workers
+model_backend = os.getenv("MODEL_BACKEND", "tensorrt" if device == "cuda" else "openvino").lower()
+if model_backend not in MODEL_BACKENDS:
+    raise ValueError(f"MODEL_BACKEND must be one of {MODEL_BACKENDS}, got {model_backend!r}")
+if model_backend == "tensorrt" and device != "cuda":
+    raise ValueError("MODEL_BACKEND=tensorrt requires a CUDA device")
+# INT8 TensorRT/OpenVINO models are calibrated on coco128 and trade some mAP for roughly 2x throughput;
+# opt-in until checked against a held-out set (calibration also downloads coco128 at export time)
+use_int8 = os.getenv("MODEL_INT8", "false").lower() == "true"
+# Where exported models are cached (engines are GPU-specific); a persistent volume lets pods reuse them.
+# The image ships the FP32 OpenVINO export here, so CPU containers don't export at startup
+model_cache_dir = Path(os.getenv("MODEL_CACHE_DIR", "."))
+# Inputs are always letterboxed to 640x640, so let cuDNN pick the fastest conv algorithms once
+torch.backends.cudnn.benchmark = True
+# Shared predict settings; class-agnostic NMS runs a single suppression pass over all boxes,
+# and imgsz matches the size the exported models are built for
+predict_args = dict(
+    device=device,
+    half=half,
+    imgsz=640,
+    conf=0.25,
+    iou=0.45,
+    agnostic_nms=True,
+    verbose=False,
+)
 
-# Load YOLO model
-model = ultralytics.YOLO(model_path)
+def exported_model_path(path):
+    """Return where the exported model for the configured backend is cached."""
+    stem = Path(path).stem
+    if model_backend == "tensorrt":
+        major, minor = torch.cuda.get_device_capability()
+        precision = "int8" if use_int8 else "fp16"
+        return model_cache_dir / f"{stem}_sm{major}{minor}_{precision}_b{BATCH_SIZE}.engine"
+    if model_backend == "onnx":
+        return model_cache_dir / f"{stem}_dynamic.onnx"  # distinct from TensorRT's intermediate ONNX
+    precision = "int8" if use_int8 else "fp32"
+    return model_cache_dir / f"{stem}_{precision}_openvino_model"  # Ultralytics detects OpenVINO by this suffix
 
-# --- Process SQS Job ---
-def process_job(message, receipt_handle):
-    """Process an image detection job from SQS."""
-    try:
-        logger.info(f"Received SQS message: {message['Body']}")
-        job = json.loads(message["Body"])
-        img_name = job.get("imgName")  # This will now be image_<number>.jpg
-        chat_id = job.get("chat_id")
-        prediction_id = str(uuid.uuid4())
-
-        if not img_name or not chat_id:
-            logger.error("Invalid job format: missing img_name or chat_id")
-            sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            return
+def export_model(path):
+    """Export the PyTorch weights for the configured backend once and return the exported path."""
+    export_path = exported_model_path(path)
+    if export_path.exists():
+        logger.info(f"Exported {model_backend} model already exists at {export_path}, skipping export.")
+        return str(export_path)
+    logger.info(f"Exporting {path} to {model_backend} model {export_path}")
+    if model_backend == "tensorrt":
+        # Dynamic batch axis up to BATCH_SIZE so partially filled batches still run on the engine
+        export_args = dict(format="engine", batch=BATCH_SIZE, dynamic=True, workspace=4, device=0)
+        export_args.update(dict(int8=True, data="data/coco128.yaml") if use_int8 else dict(half=True))
+    elif model_backend == "onnx":
+        export_args = dict(format="onnx", dynamic=True, simplify=True)
+    else:
+        export_args = dict(format="openvino", dynamic=True)
+        if use_int8:
+            export_args.update(int8=True, data="data/coco128.yaml")
+    exported = ultralytics.YOLO(path).export(imgsz=640, **export_args)
+    if Path(exported).resolve() != export_path.resolve():
+        export_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(exported, export_path)
+    return str(export_path)
 
-        logger.info(f"Processing job: {prediction_id}, Image: {img_name}, Chat ID: {chat_id}")
+def load_model(path):
+    """Load the YOLO model once at startup on the configured backend (fusing Conv+BN for PyTorch) and warm it up."""
+    if model_backend != "pytorch":
+        path = export_model(path)
+        yolo = ultralytics.YOLO(path, task="detect")
+    else:
+        yolo = ultralytics.YOLO(path)
+        yolo.fuse()
+        yolo.to(device)
+        if device == "cuda":
+            # NHWC weights let FP16 convolutions run on Tensor Cores without per-layer layout transposes
+            yolo.model.to(memory_format=torch.channels_last)
+    # Dummy forward pass so the first real job doesn't pay allocator / cuDNN autotune cost;
+    # on GPU warm the full batch shape, which is what the busy path runs
+    warmup_batch = BATCH_SIZE if device == "cuda" else 1
+    with torch.inference_mode():
+        yolo.predict([np.zeros((640, 640, 3), dtype=np.uint8)] * warmup_batch, **predict_args)
+    logger.info(f"Loaded and warmed up {model_backend} YOLO model {path} on {device} (half={half})")
+    return yolo
 
-        # Download Image from S3
-        local_img_dir = Path(f"static/data/{prediction_id}")
-        local_img_dir.mkdir(parents=True, exist_ok=True)
-        local_img_path = local_img_dir / img_name
+# --- Metrics ---
+# Per-stage latency histograms, scraped from METRICS_PORT, to show whether the worker is
+# bound by S3, MongoDB, Polybot or the model
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_DESCRIPTIONS = {
+    "lookup": "S3 HEAD and MongoDB lookup of a previous prediction for one image",
+    "s3_dl": "S3 download of one source image",
+    "predict": "YOLO forward pass over one batch",
+    "s3_ul": "S3 upload of one annotated image",
+    "mongo": "MongoDB insert of one batch of predictions",
+    "notify": "Polybot notification for one prediction",
+}
+STAGE = {
+    name: Histogram(f"stage_{name}_seconds", f"Time spent in {description}", buckets=STAGE_BUCKETS)
+    for name, description in STAGE_DESCRIPTIONS.items()
+}
 
-        try:
-            s3_client.download_file(images_bucket, img_name, str(local_img_path))
-            logger.info(f"Downloaded {img_name} from S3")
-        except Exception as e:
-            logger.error(f"Failed to download image from S3: {e}")
-            return
+# --- JPEG Codec ---
+# libjpeg-turbo's SIMD decoder/encoder when the library is installed, OpenCV otherwise
+turbo_jpeg = None
+if TurboJPEG is not None:
+    try:
+        turbo_jpeg = TurboJPEG()
+        logger.info("Using libjpeg-turbo for JPEG decode/encode")
+    except (OSError, RuntimeError) as e:
+        logger.warning(f"libjpeg-turbo unavailable, falling back to OpenCV: {e}")
 
-        ## Run YOLOv5 Object Detection
-        results = model.predict(
-            str(local_img_path),
-            save=True,
-            save_txt=True,
-            project="static/data",
-            name=prediction_id,
-            exist_ok=True
-        )
-        labels_dir = local_img_dir / "labels"
-        if labels_dir.exists() and labels_dir.is_dir():
-            logger.info(f"Labels directory exists: {labels_dir}")
-        else:
-            logger.error(f"Labels directory does not exist: {labels_dir}")
-            labels_dir.mkdir(parents=True, exist_ok=True)
-            logger.info(f"Created labels directory: {labels_dir}")
+def jpeg_orientation(data):
+    """Return the EXIF orientation tag of JPEG bytes (1, upright, if absent or unreadable)."""
+    data = bytes(data[:65536])  # APP1 segments are at most 64 KiB and come before the image data
+    offset = 2  # past the SOI marker
+    while offset + 4 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        length = int.from_bytes(data[offset + 2:offset + 4], "big")
+        if marker == 0xDA:  # start of scan: no more metadata segments
+            break
+        segment = data[offset + 4:offset + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            tiff = segment[6:]
+            byte_order = "little" if tiff[:2] == b"II" else "big"
+            ifd = int.from_bytes(tiff[4:8], byte_order)
+            for i in range(int.from_bytes(tiff[ifd:ifd + 2], byte_order)):
+                entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+                if int.from_bytes(entry[:2], byte_order) == 0x0112:
+                    return int.from_bytes(entry[8:10], byte_order) or 1
+            break
+        offset += 2 + length
+    return 1
 
-        # Upload Predictions to S3
-        predicted_s3_key = f"predictions/{prediction_id}/{img_name}"
+def decode_image(data):
+    """Decode image bytes to a BGR array, or return None if they can't be decoded."""
+    if len(data) == 0:
+        return None
+    # cv2.imdecode rotates by the EXIF orientation and TurboJPEG doesn't, so rotated photos go to OpenCV
+    if turbo_jpeg is not None and bytes(data[:2]) == b"\xff\xd8" and jpeg_orientation(data) == 1:  # JPEG SOI marker
         try:
-            s3_client.upload_file(str(local_img_path), images_bucket, predicted_s3_key)
-            logger.info(f"Uploaded predicted image to S3: {predicted_s3_key}")
-        except Exception as e:
-            logger.error(f"Failed to upload predicted image to S3: {e}")
-            return
+            return turbo_jpeg.decode(data, pixel_format=TJPF_BGR)
+        except OSError as e:
+            logger.debug(f"libjpeg-turbo failed to decode image, retrying with OpenCV: {e}")
+    try:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    except cv2.error as e:
+        logger.debug(f"OpenCV failed to decode image: {e}")
+        return None
 
-        # Parse YOLO Results
-        pred_summary_path = Path(f"static/data/{prediction_id}/labels/{Path(img_name).stem}.txt")
-        labels = []
-        if pred_summary_path.exists():
-            with open(pred_summary_path, 'r') as f:
-                lines = f.read().splitlines()
-                logger.info(f"Prediction file contents: {lines}")
-                for line in lines:
-                    if line.strip():
-                        l = line.split(" ")
-                        labels.append({
-                            "class": names[int(l[0])],
-                            "cx": float(l[1]),
-                            "cy": float(l[2]),
-                            "width": float(l[3]),
-                            "height": float(l[4]),
-                        })
-        else:
-            logger.error(f"Prediction file not found: {pred_summary_path}")
+def encode_image(image, suffix, quality):
+    """Encode a BGR array in the format of `suffix`, returning the encoded bytes."""
+    if suffix in (".jpg", ".jpeg"):
+        if turbo_jpeg is not None:
+            return turbo_jpeg.encode(image, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+        encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    else:
+        encode_params = []
+    ok, encoded = cv2.imencode(suffix, image, encode_params)
+    if not ok:
+        raise ValueError(f"could not encode image as {suffix}")
+    return encoded.tobytes()
+
+# --- Process SQS Jobs ---
+# Jobs flow through three stages connected by bounded queues:
+#   download (thread pool) -> inference (single thread, batched) -> finalize (worker threads)
+# so S3/Mongo/Polybot I/O overlaps with the YOLO forward pass.
+# Sizes are tunable per deployment to match the I/O-to-compute ratio of the node
+QUEUE_SIZE = int(os.getenv("QUEUE_SIZE", "32"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", str(BATCH_SIZE)))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", str(BATCH_SIZE)))
+FINALIZE_WORKERS = int(os.getenv("FINALIZE_WORKERS", "4"))
+# Independent consumer processes, each with its own clients, model and pipeline threads, so
+# decode/pre/postprocess CPU work in one process doesn't contend for another's GIL
+CONSUMER_PROCESSES = int(os.getenv("CONSUMER_PROCESSES", "1"))
+# Quality of the annotated JPEGs; 90 is visually lossless for box overlays and encodes faster than 95
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "90"))
+
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)  # uploads of one batch run concurrently
+notify_executor = ThreadPoolExecutor(max_workers=BATCH_SIZE)  # so do its Polybot notifications
+# Two batches of decoded images: the one being collected and the next, ready as soon as the model frees up
+inference_queue = queue.Queue(maxsize=BATCH_SIZE * 2)
+finalize_queue = queue.Queue(maxsize=QUEUE_SIZE)  # (jobs, results) batches waiting for upload
+in_flight = threading.BoundedSemaphore(QUEUE_SIZE)  # caps jobs received but not yet finalized
+# Finished receipt handles, coalesced across batches into delete_message_batch calls
+pending_deletes = collections.deque()
+DELETE_FLUSH_INTERVAL = 0.2  # seconds
+# Set once the model is loaded; SQS isn't polled before then so received messages can't sit out
+# their visibility timeout while an engine is being built or calibrated
+model_ready = threading.Event()
+
+def parse_job(message):
+    """Parse an SQS message into a job dict, or return None if the job is invalid."""
+    logger.debug(f"Received SQS message: {message['Body']}")
+    body = orjson.loads(message["Body"])
+    img_name = body.get("imgName")  # This will now be image_<number>.jpg
+    chat_id = body.get("chat_id")
+
+    if not img_name or not chat_id:
+        logger.error("Invalid job format: missing img_name or chat_id")
+        return None
 
-        # Store Prediction in MongoDB
-        prediction_summary = {
+    # Time-ordered ids append to the right edge of the _id index instead of random inserts
+    prediction_id = str(ObjectId())
+    logger.debug(f"Processing job: {prediction_id}, Image: {img_name}, Chat ID: {chat_id}")
+    return {
+        "prediction_id": prediction_id,
+        "img_name": img_name,
+        "chat_id": chat_id,
+        "receipt_handle": message["ReceiptHandle"],
+    }
+
+def find_cached_prediction(job):
+    """Record the image's S3 ETag on the job and return a stored prediction for the same image, if any."""
+    if not source_etag_indexed:
+        return None  # an unindexed find_one would scan the whole collection for every job
+    try:
+        with STAGE["lookup"].time():
+            head = s3_client.head_object(Bucket=images_bucket, Key=job["img_name"])
+            job["source_etag"] = head["ETag"].strip('"')
+            return collection.find_one(
+                {"source_etag": job["source_etag"]},
+                projection={"_id": 0, "labels": 1, "predicted_img_path": 1},
+            )
+    except Exception as e:
+        logger.error(f"Failed to look up cached prediction for {job['img_name']}: {e}")
+        return None
+
+def download_image(job):
+    """Download the job's image from S3 into memory and decode it, returning True on success."""
+    buffer = io.BytesIO()
+    try:
+        with STAGE["s3_dl"].time():
+            s3_client.download_fileobj(images_bucket, job["img_name"], buffer, Config=transfer_config)
+        logger.debug(f"Downloaded {job['img_name']} from S3")
+    except Exception as e:
+        logger.error(f"Failed to download image from S3: {e}")
+        return False
+
+    # getbuffer() exposes the downloaded bytes without copying them again before decoding
+    image = decode_image(buffer.getbuffer())
+    if image is None:
+        logger.error(f"Failed to decode image: {job['img_name']}")
+        return False
+    job["image"] = image
+    return True
+
+def build_prediction(job, result):
+    """Upload the annotated image and build its prediction summary, or return None on failure."""
+    prediction_id = job["prediction_id"]
+    img_name = job["img_name"]
+
+    # Same image already predicted: reuse its labels and annotated image
+    cached = job.get("cached")
+    if cached is not None:
+        logger.debug(f"Reusing cached prediction for {img_name} (ETag {job['source_etag']})")
+        return {
             "_id": prediction_id,
-            "chat_id": chat_id,
-            "original_img_path": img_name,  # Use the sequential name from SQS
-            "predicted_img_path": predicted_s3_key,
-            "labels": labels,
+            "chat_id": job["chat_id"],
+            "original_img_path": img_name,
+            "predicted_img_path": cached["predicted_img_path"],
+            "labels": cached["labels"],
+            "source_etag": job["source_etag"],
             "time": time.time(),
         }
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                collection.with_options(write_concern=WriteConcern("majority")).insert_one(prediction_summary)
-                logger.info(f"Prediction summary stored: {prediction_summary}")
-                logger.info(f"Stored prediction in MongoDB: {prediction_id}")
-                break
-            except (errors.NotPrimaryError, errors.ServerSelectionTimeoutError) as e:
-                logger.error(f"Retry {attempt + 1}/{max_retries} failed: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
+
+    # Upload Predictions to S3 straight from memory
+    predicted_s3_key = f"predictions/{prediction_id}/{img_name}"
+    try:
+        encoded = encode_image(result.plot(), Path(img_name).suffix.lower() or ".jpg", JPEG_QUALITY)
+        with STAGE["s3_ul"].time():
+            s3_client.upload_fileobj(io.BytesIO(encoded), images_bucket, predicted_s3_key, Config=transfer_config)
+        logger.debug(f"Uploaded predicted image to S3: {predicted_s3_key}")
+    except Exception as e:
+        logger.error(f"Failed to upload predicted image to S3: {e}")
+        return None
+
+    # Read YOLO Results directly from the in-memory boxes
+    # One device-to-host copy per image (class id next to normalized xywh), then
+    # the class column is gathered into names at once and tolist() converts the boxes in one C call
+    boxes = result.boxes
+    rows = torch.cat((boxes.cls[:, None], boxes.xywhn), dim=1).cpu().numpy()
+    classes = names_array[rows[:, 0].astype(np.intp)].tolist()
+    labels = [
+        {"class": cls, "cx": x, "cy": y, "width": w, "height": h}
+        for cls, (x, y, w, h) in zip(classes, rows[:, 1:].tolist())
+    ]
+    logger.debug(f"Detected {len(labels)} objects in {img_name}")
+
+    return {
+        "_id": prediction_id,
+        "chat_id": job["chat_id"],
+        "original_img_path": img_name,  # Use the sequential name from SQS
+        "predicted_img_path": predicted_s3_key,
+        "labels": labels,
+        "source_etag": job.get("source_etag"),
+        "time": time.time(),
+    }
+
+def store_predictions(prediction_summaries):
+    """Insert a batch of prediction summaries into MongoDB with a single round-trip, returning the stored _ids."""
+    all_ids = [prediction_summary["_id"] for prediction_summary in prediction_summaries]
+    max_retries = 5
+    for attempt in range(max_retries):
+        try:
+            with STAGE["mongo"].time():
+                collection.insert_many(prediction_summaries, ordered=False)
+            # lazy: the batch is only stringified when DEBUG is actually enabled
+            logger.opt(lazy=True).debug("Prediction summaries stored: {}", lambda: prediction_summaries)
+            logger.info(f"Stored {len(prediction_summaries)} predictions in MongoDB")
+            return set(all_ids)
+        except errors.BulkWriteError as e:
+            # A retry after a partially applied batch reports the already stored documents as duplicates
+            write_errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            failed_ids = {all_ids[err["index"]] for err in write_errors}
+            stored_ids = set(all_ids) - failed_ids
+            if write_errors:
+                logger.error(f"Failed to store {len(write_errors)} predictions in MongoDB: {write_errors}")
+            logger.info(f"Stored {len(stored_ids)} predictions in MongoDB")
+            return stored_ids
+        except (errors.NotPrimaryError, errors.ServerSelectionTimeoutError) as e:
+            logger.error(f"Retry {attempt + 1}/{max_retries} failed: {e}")
+            if attempt < max_retries - 1:
+                time.sleep(2 ** attempt)
+    logger.error("Failed to store predictions in MongoDB after all retries")
+    return set()
+
+def notify_polybot(prediction_id):
+    """Tell Polybot a prediction is ready."""
+    try:
+        logger.debug(f"Notifying Polybot at: {polybot_url}")
+        with STAGE["notify"].time():
+            polybot_response = polybot_session.post(
+                polybot_url, data=orjson.dumps({"predictionId": prediction_id}), timeout=(2, 5), verify=False
+            )
+        if polybot_response.status_code == 200:
+            logger.debug(f"Polybot notified successfully: {polybot_url}")
         else:
-            logger.error("Failed to store prediction in MongoDB after all retries")
+            logger.error(f"Polybot notification failed with status: {polybot_response.status_code}")
+    except Exception as e:
+        logger.error(f"Error notifying Polybot: {e}")
+    return prediction_id
+
+def acknowledge(receipt_handles):
+    """Queue finished messages for batched deletion from SQS."""
+    pending_deletes.extend(receipt_handles)
+
+def delete_messages(receipt_handles):
+    """Delete up to 10 messages with a single batched call, returning the receipt handles worth retrying."""
+    response = sqs_client.delete_message_batch(
+        QueueUrl=queue_url,
+        Entries=[{"Id": str(i), "ReceiptHandle": rh} for i, rh in enumerate(receipt_handles)],
+    )
+    retry = []
+    for failure in response.get("Failed", []):
+        logger.error(f"Failed to delete SQS message {failure['Id']}: {failure.get('Message')}")
+        # Sender faults (e.g. an expired receipt handle) will never succeed, so only retry the rest
+        if not failure.get("SenderFault"):
+            retry.append(receipt_handles[int(failure["Id"])])
+    logger.info(f"Removed {len(response.get('Successful', []))} messages from SQS")
+    return retry
+
+def delete_loop():
+    """Flush queued SQS deletions in batches of 10 every DELETE_FLUSH_INTERVAL seconds."""
+    while True:
+        time.sleep(DELETE_FLUSH_INTERVAL)
+        retry = []
+        while pending_deletes:
+            batch = []
+            while pending_deletes and len(batch) < SQS_MAX_MESSAGES:
+                batch.append(pending_deletes.popleft())
+            try:
+                retry.extend(delete_messages(batch))
+            except Exception as e:
+                logger.error(f"Error deleting SQS messages: {e}")
+                retry.extend(batch)
+        pending_deletes.extend(retry)
 
-        # Notify Polybot
+def download_job(job):
+    """Stage 1: fetch the job's image and hand it to the inference stage (or skip it on a cache hit)."""
+    # Runs on the download pool with nobody waiting on the future, so failures must be caught
+    # here: a job that isn't handed to the next stage has to give back its in-flight slot
+    try:
+        cached = find_cached_prediction(job)
+        if cached is not None:
+            job["cached"] = cached
+            finalize_queue.put(([job], [None]))
+            return
+        if download_image(job):
+            inference_queue.put(job)
+            return
+    except Exception as e:
+        logger.error(f"Error downloading job {job['prediction_id']}: {e}")
+    in_flight.release()
+
+def inference_worker():
+    """Load the model on the inference thread, signal that SQS polling can start, then run the inference stage."""
+    try:
+        # Download model if not present
+        download_model(model_url, model_path)
+        yolo = load_model(model_path)
+    except Exception as e:
+        logger.error(f"Failed to load YOLO model: {e}")
+        logger.complete()  # flush the enqueued sink, os._exit skips it
+        os._exit(1)  # let the orchestrator restart the pod instead of polling without a model
+    model_ready.set()
+    inference_loop(yolo)
+
+def inference_loop(yolo):
+    """Stage 2: drain downloaded jobs into batches and run one forward pass per batch on the given model."""
+    while True:
+        jobs = [inference_queue.get()]
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        while len(jobs) < BATCH_SIZE:
+            try:
+                jobs.append(inference_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
         try:
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            logger.info(f"Notifying Polybot at: {polybot_url}")
-            logger.info(f"Polybot URL: {polybot_url}")
-            polybot_response = requests.post(polybot_url, json={"predictionId": prediction_id}, timeout=10, verify=False)
-            if polybot_response.status_code == 200:
-                logger.info(f"Polybot notified successfully: {polybot_url}")
-            else:
-                logger.error(f"Polybot notification failed with status: {polybot_response.status_code}")
+            ## Run YOLOv5 Object Detection on the whole batch
+            with torch.inference_mode(), STAGE["predict"].time():
+                results = yolo.predict([job.pop("image") for job in jobs], **predict_args)
         except Exception as e:
-            logger.error(f"Error notifying Polybot: {e}")
+            logger.error(f"Error running inference on batch of {len(jobs)}: {e}")
+            for _ in jobs:
+                in_flight.release()
+            continue
+        logger.info(f"Ran inference on a batch of {len(jobs)} images")
+        finalize_queue.put((jobs, results))
+
+def finalize_loop():
+    """Stage 3: upload, store and announce each prediction, then queue the batch for deletion."""
+    while True:
+        jobs, results = finalize_queue.get()
+        done = []
+        prediction_summaries = []
+        receipt_handles = {}  # prediction _id -> SQS receipt handle
+        futures = [upload_executor.submit(build_prediction, job, result) for job, result in zip(jobs, results)]
+        for job, future in zip(jobs, futures):
+            try:
+                prediction_summary = future.result()
+            except Exception as e:
+                logger.error(f"Error processing job {job['prediction_id']}: {e}")
+                continue
+            if prediction_summary is not None:
+                prediction_summaries.append(prediction_summary)
+                receipt_handles[prediction_summary["_id"]] = job["receipt_handle"]
 
-        # Delete Message from SQS
-        sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-        logger.info(f"Job {prediction_id} completed and removed from SQS")
+        # Store Predictions in MongoDB, then Notify Polybot about the ones actually written;
+        # the rest stay in SQS and are redelivered
+        if prediction_summaries:
+            try:
+                stored_ids = store_predictions(prediction_summaries)
+            except Exception as e:
+                logger.error(f"Error storing predictions: {e}")
+                stored_ids = set()
+            # Fan the notifications out so one slow Polybot response doesn't serialize the batch
+            prediction_ids = [
+                prediction_summary["_id"]
+                for prediction_summary in prediction_summaries
+                if prediction_summary["_id"] in stored_ids
+            ]
+            for prediction_id in notify_executor.map(notify_polybot, prediction_ids):
+                logger.debug(f"Job {prediction_id} completed")
+                done.append(receipt_handles[prediction_id])
 
-    except Exception as e:
-        logger.error(f"Error processing job: {e}")
-        time.sleep(1)
+        # Delete Messages from SQS
+        acknowledge(done)
+        for _ in jobs:
+            in_flight.release()
+
+def dispatch(messages):
+    """Parse received messages and submit valid jobs to the download stage."""
+    invalid = []
+    for message in messages:
+        try:
+            job = parse_job(message)
+        except Exception as e:
+            logger.error(f"Error parsing job: {e}")
+            continue
+        if job is None:
+            invalid.append(message["ReceiptHandle"])
+            continue
+        in_flight.acquire()
+        download_executor.submit(download_job, job)
+    acknowledge(invalid)
 
 # --- Main Consumer Loop ---
-def consume():
-    """Polls SQS queue for messages and processes image jobs."""
+def consume(metrics_port=METRICS_PORT):
+    """Starts the metrics endpoint and pipeline workers, then polls SQS for batches of image jobs."""
+    start_http_server(metrics_port)
+    logger.info(f"Serving metrics on port {metrics_port}")
+    threading.Thread(target=inference_worker, name="inference", daemon=True).start()
+    for i in range(FINALIZE_WORKERS):
+        threading.Thread(target=finalize_loop, name=f"finalize-{i}", daemon=True).start()
+    threading.Thread(target=delete_loop, name="sqs-delete", daemon=True).start()
+    logger.info("Waiting for the model to load before polling SQS")
+    model_ready.wait()
+
     while True:
         try:
+            # Long polling: SQS holds the request open until a message arrives or 20s elapse
             response = sqs_client.receive_message(
-                QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=5
+                QueueUrl=queue_url, MaxNumberOfMessages=SQS_MAX_MESSAGES, WaitTimeSeconds=20
             )
             if "Messages" not in response:
                 logger.info("No messages in SQS queue. Waiting...")
-                time.sleep(10)
                 continue
 
-            message = response["Messages"][0]
-            receipt_handle = message["ReceiptHandle"]
-            process_job(message, receipt_handle)
+            dispatch(response["Messages"])
         except Exception as e:
             logger.error(f"Error in main loop: {e}")
             time.sleep(1)
 
+def prepare_model():
+    """Download the weights and build the backend's export so consumers find them cached."""
+    download_model(model_url, model_path)
+    if model_backend != "pytorch":
+        export_model(model_path)
+
+def run_consumers(count):
+    """Run `count` consumer processes, exiting as soon as any of them dies."""
+    # spawn, not fork: CUDA and the boto3/pymongo pools of this process can't be shared with children
+    context = multiprocessing.get_context("spawn")
+    # Fetch and export the model once up front so the consumers don't race to build it. This runs in
+    # its own short-lived process so the supervisor never holds a CUDA context the consumers need
+    preparer = context.Process(target=prepare_model, name="model-prepare")
+    preparer.start()
+    preparer.join()
+    if preparer.exitcode != 0:
+        logger.error(f"Model preparation failed with exit code {preparer.exitcode}")
+        logger.complete()  # flush the enqueued sink, os._exit skips it
+        os._exit(1)
+    # Each consumer has its own metrics registry, so each serves it on its own port
+    processes = [
+        context.Process(target=consume, args=(METRICS_PORT + i,), name=f"consumer-{i}") for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {count} consumer processes")
+    multiprocessing.connection.wait([process.sentinel for process in processes])
+    for process in processes:
+        if not process.is_alive():
+            logger.error(f"Consumer {process.name} exited with code {process.exitcode}, shutting down")
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    logger.complete()  # flush the enqueued sink, os._exit skips it
+    os._exit(1)  # let the orchestrator restart the pod
+
 ## Start consumer
 if __name__ == "__main__":
-    consume()
\ No newline at end of file
+    if CONSUMER_PROCESSES > 1:
+        run_consumers(CONSUMER_PROCESSES)
+    else:
+        consume()
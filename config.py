@@ -0,0 +1,158 @@
+import time
+import os
+import sys
+import functools
+from pathlib import Path
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import orjson
+from loguru import logger
+from pymongo import MongoClient, errors
+from pymongo.write_concern import WriteConcern
+
+# --- Logging ---
+logger.remove()  # Remove default handler
+# enqueue=True hands formatting and writing to a background thread so workers never block on stderr
+logger.add(sys.stderr, level=os.getenv("LOG_LEVEL", "INFO"), enqueue=True)
+
+region_name = "eu-north-1"
+
+# --- Load Secrets from AWS Secrets Manager ---
+# Short-lived local copy so pod restarts and rolling deploys skip the Secrets Manager round-trip;
+# kept in /dev/shm (RAM-backed, gone on reboot) when available so secrets never hit the disk
+SECRETS_CACHE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+SECRETS_CACHE_PATH = Path(os.getenv("SECRETS_CACHE_PATH", f"{SECRETS_CACHE_DIR}/polybot-secrets.json"))
+SECRETS_CACHE_TTL = 300  # seconds
+
+def read_cached_secrets():
+    """Return the locally cached secrets if they are fresh enough, else None."""
+    try:
+        if time.time() - SECRETS_CACHE_PATH.stat().st_mtime < SECRETS_CACHE_TTL:
+            return orjson.loads(SECRETS_CACHE_PATH.read_bytes())
+    except (OSError, ValueError):
+        pass
+    return None
+
+def write_cached_secrets(secrets):
+    """Atomically write the secrets cache, readable by the owner only."""
+    tmp_path = SECRETS_CACHE_PATH.with_suffix(".tmp")
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(secrets))
+        os.replace(tmp_path, SECRETS_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Failed to cache secrets at {SECRETS_CACHE_PATH}: {e}")
+
+@functools.lru_cache(maxsize=1)
+def load_secrets():
+    """Retrieve all secrets from the local cache or AWS Secrets Manager (once per process)"""
+    secrets = read_cached_secrets()
+    if secrets is not None:
+        logger.info(f"Loaded secrets from cache {SECRETS_CACHE_PATH}")
+        return secrets
+    try:
+        secrets_client = boto3.client("secretsmanager", region_name=region_name)
+        response = secrets_client.get_secret_value(SecretId="polybot-secrets")
+        secrets = orjson.loads(response["SecretString"])
+        logger.info("Loaded secrets from AWS Secrets Manager")
+    except Exception as e:
+        logger.error(f"Failed to load secrets from AWS Secrets Manager: {e}")
+        raise
+    write_cached_secrets(secrets)
+    return secrets
+
+secrets = load_secrets()
+
+# --- Service Settings ---
+images_bucket = secrets.get("S3_BUCKET_NAME", "")
+queue_url = secrets.get("SQS_QUEUE_URL", "")
+polybot_url = secrets.get("POLYBOT_URL", "")
+
+# --- AWS Clients ---
+# One session shared by every client so credentials are resolved once; they come from the
+# default chain (IAM role via IMDS, env vars), which botocore caches and refreshes before expiry
+aws_session = boto3.Session(region_name=region_name)
+# Larger keep-alive pool for the download/upload/delete threads, adaptive retries for throttling
+client_config = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": 5},
+)
+sqs_client = aws_session.client("sqs", config=client_config)
+# Transfer Acceleration routes S3 traffic through the nearest edge location; the bucket must have it enabled
+s3_accelerate = os.getenv("S3_ACCELERATE", "false").lower() == "true"
+s3_client = aws_session.client(
+    "s3", config=client_config.merge(Config(s3={"use_accelerate_endpoint": s3_accelerate}))
+)
+# Shared transfer settings: multipart + concurrent part transfers for large objects
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+# --- MongoDB Connection with Retry ---
+def connect_to_mongo():
+    mongo_uri = secrets.get("MONGO_URI")
+    if not mongo_uri:
+        logger.error("MONGO_URI is missing from secrets")
+        raise ValueError("MONGO_URI is missing from AWS Secrets Manager")
+    logger.info(f"Using MONGO_URI before connection: {mongo_uri}")
+    max_retries = 5
+    for attempt in range(1, max_retries + 1):
+        try:
+            logger.info(f"Attempt {attempt} with MONGO_URI: {mongo_uri}")
+            # Pool sized for the finalize workers; minPoolSize keeps authenticated connections warm.
+            # zstd wire compression shrinks the label-heavy insert batches (needs the zstandard package)
+            mongo_client = MongoClient(
+                mongo_uri,
+                retryWrites=True,
+                retryReads=True,
+                maxPoolSize=32,
+                minPoolSize=4,
+                socketTimeoutMS=5000,
+                compressors="zstd",
+                serverSelectionTimeoutMS=5000,  # fail the attempt fast and let the backoff loop retry
+            )
+            db = mongo_client[secrets.get("MONGO_DB", "config")]
+            # w=1 without journaling: acknowledged by the primary, no fsync wait per batch
+            collection = db.get_collection(
+                secrets.get("MONGO_COLLECTION", "image_collection"),
+                write_concern=WriteConcern(w=1, j=False),
+            )
+            mongo_client.admin.command("ping")
+            logger.info("Connected to MongoDB successfully")
+            return collection
+        except (errors.ConnectionFailure, errors.NotPrimaryError) as e:
+            logger.error(f"MongoDB connection attempt {attempt} failed: {e}")
+            if attempt < max_retries:
+                time.sleep(2 ** attempt)
+    logger.error("MongoDB connection failed after retries")
+    raise ConnectionError("Could not connect to MongoDB after multiple retries")
+
+# Initialize MongoDB connection
+collection = connect_to_mongo()
+# Lets the worker find an existing prediction for a re-sent image by its S3 ETag. Building it on a
+# large existing collection can outlast socketTimeoutMS; without it the worker skips the lookup
+# rather than scan the collection for every job
+def ensure_source_etag_index():
+    """Create the source_etag index if needed and return whether it exists."""
+    try:
+        collection.create_index("source_etag")
+        return True
+    except errors.PyMongoError as e:
+        logger.warning(f"Could not create source_etag index, create it out of band: {e}")
+    try:
+        return any(
+            index["key"][0][0] == "source_etag" for index in collection.index_information().values()
+        )
+    except errors.PyMongoError as e:
+        logger.warning(f"Could not list indexes: {e}")
+        return False
+
+source_etag_indexed = ensure_source_etag_index()
+if not source_etag_indexed:
+    logger.warning("source_etag index missing, cached prediction lookups are disabled")